@@ -1,16 +1,23 @@
 import os
+import csv
 import numpy as np
 import pandas as pd
-import pingouin as pg
 import matplotlib.pyplot as plt
 import scipy.stats as sps
 import statsmodels.stats.multitest as smsm
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from tqdm import trange
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score, pairwise_distances
+from tqdm import tqdm
+from joblib import Parallel, delayed, parallel_backend
 import seaborn as sns
 import matplotlib.colors as mcolors
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
 # 整理数据，方便后续计算
 # 输入原始数据（.csv文件，包括表型信息和体积指标，meta+data），得到patients.csv和controls.csv两个文件，其中只包含个体编号、协变量、脑区体积信息等后续要用的；
 # group_index：输入文件中，区分疾病和健康的一列的index；group_name：2个元素的列表，第一个为ctrl的名称（小鼠用'WT'），第二个为patient的名称（小鼠用'MUT'）。
@@ -95,10 +102,8 @@ def generate_dataset(filepath, outpath, group_name, group_index, cova_name, regi
     col_group = source.columns.values[0]
     source = source.dropna(axis=0)
     for cvn in cova_name:
-        if source[cvn].dtype == 'object':
-            factors = set(list(source[cvn].values))
-            for j, f in zip(range(len(factors)), factors):
-                source[cvn] = source[cvn].replace(f, j + 1)
+        if not pd.api.types.is_numeric_dtype(source[cvn]):
+            source[cvn] = source[cvn].astype('category').cat.codes.astype(np.int64) + 1
     if tp == '0':
         hc = (source.loc[source[col_group].isin(group_name[0])])[source.columns.values[1:]]
         pa = (source.loc[source[col_group].isin(group_name[1])])[source.columns.values[1:]]
@@ -187,35 +192,110 @@ def PCC(covas, regions, group):
     assert isinstance(group, pd.DataFrame), 'ctrl_group must be a pandas.core.frame.DataFrame.'
 
     # calculate partial_corr
-    pcorr = []
-    for r1 in regions:
-        pcorr_col = []
-        for r2 in regions:
-            if r1 != r2:
-                results = pg.partial_corr(data=group, x=r1, y=r2, covar=covas)
-                pcorr_col.append(results.r.values[0])
-            else:
-                pcorr_col.append(1.0)
-        pcorr.append(pcorr_col)
-    return np.array(pcorr).astype(np.float_)
+    pcorr = _pcc_from_arrays(group[covas].values.astype(np.float64), group[regions].values.astype(np.float64))
+    return pcorr.astype(np.float64, copy=False)
+
+
+def _pcc_from_arrays(C, Y):
+    # regress all regions on the covariates at once, the pairwise partial correlation
+    # (controlling for covas) is then the Pearson correlation between the residuals.
+    X = np.column_stack([np.ones(C.shape[0]), C])
+    B, *_ = np.linalg.lstsq(X, Y, rcond=None)
+    resid = Y - X @ B
+    pcorr = np.corrcoef(resid, rowvar=False)
+    np.fill_diagonal(pcorr, 1.0)
+    return pcorr
 
 
-def mix_group(cols, ctrl, pati):
+def PCC_split_batch(X, Y, idx):
     """
-    This method will mix a patient into the control group and return mixed group.
-
-    :param cols:list
-           name list of ctrl DataFrame columns.
-    :param ctrl:pandas.core.frame.DataFrame
-           control group data.
-    :param pati:numpy.ndarray
-           patient data.
-    :return: mixed
+    This method will generate the partial correlation matrices of the two groups that split the cohort,
+    for a stack of splits at once. The cross-products of the whole cohort are computed once, those of
+    the second group are the whole cohort minus the first group.
+
+    :param X: numpy.ndarray
+           design matrix (intercept and covariates) of the whole cohort, shape (n_subject, n_cova + 1).
+    :param Y: numpy.ndarray
+           regions of the whole cohort, shape (n_subject, n_region).
+    :param idx: numpy.ndarray
+           row indices of the first group of every split, shape (n_split, n_first).
+    :return: (PCC stack of the first group, PCC stack of the second group)
     """
-    prow = np.array([list(pati)])
-    pati = pd.DataFrame(prow, columns=cols)
-    mixed = pd.concat([ctrl, pati])
-    return mixed
+    XtX = X.T @ X
+    XtY = X.T @ Y
+    YtY = Y.T @ Y
+    X1 = X[idx]
+    Y1 = Y[idx]
+    X1t = X1.transpose(0, 2, 1)
+    XtX1 = X1t @ X1
+    XtY1 = X1t @ Y1
+    YtY1 = Y1.transpose(0, 2, 1) @ Y1
+    return _pcc_from_gram(XtX1, XtY1, YtY1), _pcc_from_gram(XtX - XtX1, XtY - XtY1, YtY - YtY1)
+
+
+def _pcc_from_gram(XtX, XtY, YtY):
+    # residual cross-product of Y regressed on X: YtY - YtX (XtX)^+ XtY
+    # the pseudo-inverse gives the same residuals as lstsq when the design is rank-deficient
+    # (e.g. a covariate constant within a group), the cutoff is relative to the largest
+    # eigenvalue of XtX, whose condition number is the square of that of X.
+    B = np.linalg.pinv(XtX, rcond=1e-10, hermitian=True) @ XtY
+    S = YtY - XtY.transpose(0, 2, 1) @ B
+    d = np.sqrt(np.diagonal(S, axis1=1, axis2=2))
+    pcorr = S / (d[:, :, None] * d[:, None, :])
+    pcorr[:, np.arange(pcorr.shape[1]), np.arange(pcorr.shape[2])] = 1.0
+    return pcorr
+
+
+def ctrl_basis(ctrl_arr, n_cova):
+    """
+    This method will precompute the QR decomposition of the control group covariate design,
+    so that PCCn+1 of every patient can be derived without refitting the whole mixed group.
+
+    :param ctrl_arr: numpy.ndarray
+           control group data (covariates in front and regions behind).
+    :param n_cova: int
+           number of covariates.
+    :return: (mu, R, QtY, YtY, n)
+    """
+    X = np.column_stack([np.ones(ctrl_arr.shape[0]), ctrl_arr[:, :n_cova]])
+    Y = ctrl_arr[:, n_cova:]
+    # regions are centered on the control means to limit cancellation in YtY - ZtZ,
+    # the residuals are unchanged because the design contains an intercept.
+    mu = Y.mean(axis=0)
+    Y = Y - mu
+    Q, R = np.linalg.qr(X)
+    return mu, R, Q.T @ Y, Y.T @ Y, X.shape[0]
+
+
+def PCC_add_subject(basis, cova, region):
+    """
+    This method will generate the partial correlation matrix of the control group mixed with
+    one patient (i.e. PCCn+1), using the precomputed control basis.
+
+    :param basis: tuple
+           return value of ctrl_basis.
+    :param cova: numpy.ndarray
+           covariates of the patient.
+    :param region: numpy.ndarray
+           regions of the patient.
+    :return: PCCn+1
+    """
+    mu, R, QtY, YtY, n = basis
+    x = np.concatenate([[1.0], np.asarray(cova, dtype=np.float64)])
+    y = np.asarray(region, dtype=np.float64) - mu
+    # [X_ctrl; x] = diag(Q, 1) @ [R; x], so only the small (k+2)x(k+1) matrix has to be refactorized.
+    # diag(Q, 1) has orthonormal columns, so [R; x] has the singular values of the mixed design and
+    # its left singular vectors above the lstsq cutoff span the same space even if the design is
+    # rank-deficient (e.g. a constant covariate).
+    M = np.vstack([R, x])
+    U, s, _ = np.linalg.svd(M, full_matrices=False)
+    rank = np.count_nonzero(s > s[0] * max(n + 1, M.shape[1]) * np.finfo(np.float64).eps)
+    Z = U[:, :rank].T @ np.vstack([QtY, y])
+    S = YtY + np.outer(y, y) - Z.T @ Z
+    d = np.sqrt(np.diag(S))
+    pcorr = S / np.outer(d, d)
+    np.fill_diagonal(pcorr, 1.0)
+    return pcorr
 
 
 def Z_score(PCCn, delta_PCC):
@@ -232,17 +312,33 @@ def Z_score(PCCn, delta_PCC):
     assert PCCn.shape == delta_PCC.shape, 'shape of PCCn and delta_PCC must be equal.'
 
     n = PCCn.shape[0]
-    ones = np.ones(PCCn.shape, dtype=np.float_)
-    d = ones - PCCn * PCCn
-    for i in range(n):
-        d[i][i] = 1
-    Z = (n - 1) * delta_PCC / d
-    for i in range(n):
-        Z[i][i] = 1
+    d = np.empty_like(PCCn, dtype=np.float64)
+    np.multiply(PCCn, PCCn, out=d)
+    np.subtract(1.0, d, out=d)
+    np.fill_diagonal(d, 1.0)
+    Z = np.multiply(delta_PCC, n - 1, dtype=np.float64)
+    Z /= d
+    np.fill_diagonal(Z, 1.0)
     return Z
 
 
-def IDSCN(inpath, outpath, cova=None, region=None):
+def _process_patient(sub, p, PCCn, basis, n_cova, outPath):
+    PCCn_1 = PCC_add_subject(basis, p[:n_cova], p[n_cova:])
+    delta_PCC = PCCn_1 - PCCn
+    Z = Z_score(PCCn, delta_PCC)
+    ori_P, correct_P = P(Z)
+    if not os.path.exists(outPath + '/' + sub):
+        os.mkdir(outPath + '/' + sub)
+    # 个体矩阵保存为.npy，避免 float->text->float 的转换
+    np.save(outPath + '/' + sub + '/' + sub + '_PCCn+1.npy', PCCn_1)
+    np.save(outPath + '/' + sub + '/' + sub + '_Z.npy', Z)
+    np.save(outPath + '/' + sub + '/' + sub + '_P.npy', ori_P)
+    np.save(outPath + '/' + sub + '/' + sub + '_P_FDR.npy', correct_P)
+    print('Subject: ', sub, ' done.')
+    return sub, np.count_nonzero(correct_P < 0.05)
+
+
+def IDSCN(inpath, outpath, cova=None, region=None, n_jobs=-1):
     if os.path.isdir(outpath):
         l = os.listdir(outpath)
         if len(l) != 0:
@@ -259,79 +355,149 @@ def IDSCN(inpath, outpath, cova=None, region=None):
     print('Patients are in {}'.format(pati_path))
     ctrl = read_dataset(filepath=ctrl_path, tp='ctrl', cova=cova, region=region)
     pati = read_dataset(filepath=pati_path, tp='pati', cova=cova, region=region)
-    df = pd.DataFrame(columns=ctrl[1], index=ctrl[1])
     PCCn = PCC(covas=ctrl[0], regions=ctrl[1], group=ctrl[2])
-    df.iloc[:, :] = PCCn.T
-    df.to_csv(outPath + '/PCCn.csv')
+    save_matrix_csv(outPath + '/PCCn.csv', PCCn, ctrl[1])
     print('PCCn done.')
     # np.savetxt(outPath + '/PCCn.csv', PCCn, delimiter=',')
     np.savetxt(outPath + '/covas.txt', np.array(ctrl[0]), delimiter=',', fmt='%s')
     np.savetxt(outPath + '/regions.txt', np.array(ctrl[1]), delimiter=',', fmt='%s')
     pa = pati[3].values
-    df_n = pd.DataFrame(columns=['subject', 'n'])
-    for sub, p in zip(pati[0], pa):
-        mixed_group = mix_group(ctrl[0] + ctrl[1], ctrl[2], p)
-        PCCn_1 = PCC(ctrl[0], ctrl[1], mixed_group)
-        delta_PCC = PCCn_1 - PCCn
-        Z = Z_score(PCCn, delta_PCC)
-        ori_P, correct_P = P(Z)
-        if not os.path.exists(outPath + '/' + sub):
-            os.mkdir(outPath + '/' + sub)
-        df.iloc[:, :] = PCCn_1.T
-        df.to_csv(outPath + '/' + sub + '/' + sub + '_PCCn+1.csv')
-        df.iloc[:, :] = Z.T
-        df.to_csv(outPath + '/' + sub + '/' + sub + '_Z.csv')
-        df.iloc[:, :] = ori_P.T
-        df.to_csv(outPath + '/' + sub + '/' + sub + '_P.csv')
-        df.iloc[:, :] = correct_P.T
-        df.to_csv(outPath + '/' + sub + '/' + sub + '_P_FDR.csv')
-        df.loc[len(df.index)] = [sub, np.count_nonzero(correct_P < 0.05)]
-        # np.savetxt(outPath + '/' + sub + '/' + sub + '_PCCn+1.csv', PCCn_1, delimiter=',')
-        # np.savetxt(outPath + '/' + sub + '/' + sub + '_Z.csv', Z, delimiter=',')
-        print('Subject: ', sub, ' done.')
+    n_cova = len(ctrl[0])
+    ctrl_arr = ctrl[2][ctrl[0] + ctrl[1]].values.astype(np.float64)
+    basis = ctrl_basis(ctrl_arr, n_cova)
+    # 每个病人的计算相互独立，多进程并行；每个进程的 BLAS 只用单线程，避免线程过载
+    with parallel_backend('loky', inner_max_num_threads=1):
+        counts = Parallel(n_jobs=n_jobs)(
+            delayed(_process_patient)(sub, p, PCCn, basis, n_cova, outPath) for sub, p in zip(pati[0], pa))
+    df_n = pd.DataFrame(counts, columns=['subject', 'n'])
     df_n.to_csv(outPath + '/count_significant.csv', index=False)
     print("All subjects' PCC are generated successfully!")
 
 
+def save_matrix_csv(path, m, names):
+    """
+    This method will save a region x region matrix as .csv with region names as header and index,
+    in the same layout as DataFrame.to_csv (names quoted when needed, shortest round-trip floats,
+    empty field for NaN), without going through a DataFrame.
+
+    :param path: str
+           path of the .csv file.
+    :param m: numpy.ndarray
+           matrix to save.
+    :param names: list
+           name list of regions.
+    """
+    rows = np.where(np.isnan(m.T), None, m.T.astype(object)).tolist()
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + list(names))
+        writer.writerows([name] + row for name, row in zip(names, rows))
+
+
 def read_matrix(path, tp):
     assert tp in ['pcc', 'z', 'sg'], 'tp must be in ["pcc", "z", "sg"]'
-    dtype = np.int_
+    dtype = np.int64
     if tp in ['pcc', 'z']:
-        dtype = np.float_
+        dtype = np.float64
+    if path.endswith('.npy'):
+        return np.load(path).astype(dtype, copy=False)
     m = pd.read_csv(path, index_col=0).astype(dtype)
     return m.values
 
 
+def list_subjects(inputdir):
+    """
+    This method will list the subject directories generated by IDSCN, the file type comes
+    with the directory entry so no extra stat call is needed.
+    """
+    with os.scandir(inputdir) as it:
+        return [e.name for e in it if e.is_dir()]
+
+
+def read_subject_matrix(inputdir, sub, name, tp):
+    """
+    This method will read a matrix generated by IDSCN for one subject, e.g. name='Z' reads
+    sub_Z.npy, falling back to sub_Z.csv for results generated by older versions.
+    """
+    path = os.path.join(inputdir, sub, sub + '_' + name + '.npy')
+    if not os.path.exists(path):
+        path = path[:-len('.npy')] + '.csv'
+    return read_matrix(path, tp)
+
+
 def P(Z):
     p = sps.norm.sf(abs(Z)) * 2
-    shape = p.shape
-    correct_P = smsm.fdrcorrection(p.flatten())
-    return p, correct_P[1].reshape(shape)
+    return p, FDR(p)
+
+
+def FDR(p):
+    # 每条边只作为一次检验做 FDR 校正（上三角），再对称填回，对角线为 1
+    rows, cols = np.triu_indices(p.shape[0], 1)
+    fdr_ut = smsm.fdrcorrection(p[rows, cols])[1]
+    correct_P = np.ones(p.shape)
+    correct_P[rows, cols] = fdr_ut
+    correct_P[cols, rows] = fdr_ut
+    return correct_P
+
+
+def count_significant(Zs, fdr=True):
+    """
+    This method will count, for every connection, the number of patients with p < 0.05.
+
+    :param Zs: numpy.ndarray
+           Z matrices of all patients, shape (n_patient, n_region, n_region).
+    :param fdr: bool
+           whether to threshold the FDR corrected p-values.
+    :return: significant
+    """
+    rows, cols = np.triu_indices(Zs.shape[-1], 1)
+    flat = rows * Zs.shape[-1] + cols
+    # 逐个病人把上三角 |Z| 取到复用的缓冲区 buf，阈值结果写入复用的 bool 缓冲区 mask
+    count_ut = np.zeros(rows.shape[0], dtype=np.int64)
+    buf = np.empty(rows.shape[0], dtype=np.float64)
+    mask = np.empty(rows.shape[0], dtype=bool)
+    # p < 0.05 等价于 |Z| > norm.isf(0.025)，不做 FDR 时不需要计算 p 值
+    z_thresh = sps.norm.isf(0.025)
+    for Z in Zs:
+        np.take(Z, flat, out=buf)
+        np.abs(buf, out=buf)
+        if fdr:
+            correct_P = smsm.fdrcorrection(sps.norm.sf(buf) * 2)[1]
+            np.less(correct_P, 0.05, out=mask)
+        else:
+            np.greater(buf, z_thresh, out=mask)
+        count_ut += mask
+    significant = np.zeros(Zs.shape[1:], dtype=np.int64)
+    significant[rows, cols] = count_ut
+    significant[cols, rows] = count_ut
+    return significant
+
+
+def sort_edges(count):
+    """
+    This method will sort the (i, j) of the lower triangle of count in descending order of count,
+    the order within the same count is the row-major order of (i, j).
+
+    :param count: numpy.ndarray
+           number of significant patients of every connection.
+    :return: (vals, rows, cols)
+    """
+    rows, cols = np.tril_indices(count.shape[0])
+    vals = count[rows, cols]
+    order = np.argsort(-vals, kind='stable')
+    return vals[order], rows[order], cols[order]
 
 
 def draw_signifcant(savepath, count, re_col, plot):
-    index_dict = {}
-    for i in range(count.shape[0]):
-        for j in range(i + 1):
-            if count[i][j] in index_dict.keys():
-                index_dict[count[i][j]][0] += 1
-                index_dict[count[i][j]][1].append((i, j))
-            else:
-                index_dict[count[i][j]] = [1, [(i, j)]]
-    index_tuple = sorted(zip(index_dict.keys(), index_dict.values()), reverse=True)
+    vals, rows, cols = sort_edges(count)
     if plot:
-        name_list = []
-        y = []
-        for c, locs in index_tuple:
-            for loc in locs[1]:
-                if c != 0:
-                    name_list.append(re_col[loc[0]] + '--' + re_col[loc[1]])
-                    y.append(c)
-        view_len = int(len(name_list) * 0.1)
+        nz = vals != 0
+        view_len = int(np.count_nonzero(nz) * 0.1)
         if view_len > 200:
             view_len = 200
-        name_list = name_list[:view_len]
-        y = y[:len(name_list)]
+        name_list = [re_col[i] + '--' + re_col[j] for i, j in zip(rows[nz][:view_len].tolist(),
+                                                                   cols[nz][:view_len].tolist())]
+        y = list(vals[nz][:view_len])
         plt.figure(figsize=(100, 15))
         plt.bar(range(len(name_list)), y, tick_label=name_list)
         for name, num in zip(range(len(name_list)), y):
@@ -344,6 +510,14 @@ def draw_signifcant(savepath, count, re_col, plot):
         plt.tight_layout()
         plt.savefig(savepath)
         plt.show()
+    # group the sorted (i, j) by count
+    locs = list(zip(rows.tolist(), cols.tolist()))
+    keys, nums = np.unique(vals, return_counts=True)
+    index_tuple = []
+    start = 0
+    for c, num in zip(keys[::-1], nums[::-1]):
+        index_tuple.append((c, [int(num), locs[start:start + num]]))
+        start += num
     return index_tuple
 
 
@@ -363,24 +537,12 @@ def subtype(input_dir, outpath, plot=True):
     inputdir = input_dir
     if input_dir[-1] in ['/', '\\']:
         inputdir = input_dir[:-1]
-    dirlist = os.listdir(inputdir)
-    assert 'regions.txt' in dirlist, 'regions.txt not found.'
-    f_re = open(inputdir + '/regions.txt', 'r')
-    regions = [line.strip() for line in f_re.readlines()]
-    pati = []
-    for f in dirlist:
-        if os.path.isdir(inputdir + '/' + f):
-            pati.append(f)
-    significant = None
-    for p in pati:
-        Z = read_matrix(inputdir + '/' + p + '/' + p + '_Z.csv', tp='z')
-        if significant is None:
-            significant = np.zeros(Z.shape)
-        _, correct_P = P(Z)
-        signi_conn_index = np.argwhere(correct_P < 0.05)
-        if signi_conn_index.shape[0] > 0:
-            rows, cols = zip(*signi_conn_index)
-            significant[rows, cols] = significant[rows, cols] + 1
+    assert os.path.isfile(os.path.join(inputdir, 'regions.txt')), 'regions.txt not found.'
+    with open(os.path.join(inputdir, 'regions.txt'), 'r') as f_re:
+        regions = [line.strip() for line in f_re.readlines()]
+    pati = list_subjects(inputdir)
+    Zs = np.stack([read_subject_matrix(inputdir, p, 'Z', tp='z') for p in pati])
+    significant = count_significant(Zs, fdr=True)
     sorted_edges = draw_signifcant(inputdir + '/' + inputdir.strip().split('/')[-1] + '.jpg', significant, regions,
                                    plot)
     sg_num = []
@@ -395,18 +557,28 @@ def subtype(input_dir, outpath, plot=True):
     row, col = zip(*selected_edges)
     cluster_source = []
     for p in pati:
-        PCCn_1 = read_matrix(inputdir + '/' + p + '/' + p + '_PCCn+1.csv', tp='pcc')
-        if PCCn_1 is not None:
-            dist = np.ones((len(selected_edges),)) - PCCn_1[row, col]
-            cluster_source.append(dist)
+        PCCn_1 = read_subject_matrix(inputdir, p, 'PCCn+1', tp='pcc')
+        dist = np.ones((len(selected_edges),)) - PCCn_1[row, col]
+        cluster_source.append(dist)
     cluster_source = np.array(cluster_source)
     dist_pred = None
     max_sc = -2
     k_last = 1
 
+    large = len(pati) > 5000
+    # 小样本时样本间距离只计算一次，各个 k 的轮廓系数共用；
+    # 大样本时 P×P 距离矩阵太大，由 silhouette_score 分块计算
+    distances = None if large else pairwise_distances(cluster_source)
     for k in range(2, 6):
-        dist_pred_k = KMeans(n_clusters=k, n_init=100).fit_predict(cluster_source.copy())
-        sc = silhouette_score(cluster_source.copy(), dist_pred_k)
+        if large:
+            km = MiniBatchKMeans(n_clusters=k, batch_size=1024, n_init=5, random_state=0)
+        else:
+            km = KMeans(n_clusters=k, n_init=10, algorithm='elkan', random_state=0)
+        dist_pred_k = km.fit_predict(cluster_source)
+        if large:
+            sc = silhouette_score(cluster_source, dist_pred_k)
+        else:
+            sc = silhouette_score(distances, dist_pred_k, metric='precomputed')
         if sc > max_sc:
             max_sc = sc
             dist_pred = dist_pred_k
@@ -456,11 +628,9 @@ def difference(inpath, outpath):
     dif_group = (PCCp - PCCh) / (PCCp + PCCh)
     n = 0
     Z = np.zeros(dif_group.shape)
-    for root, dirs, files in os.walk(outpath, topdown=False):
-        if len(files) == 2:
-            z_path = os.path.join(root, [i for i in files if 'Z.csv' in i][0])
-            Z += pd.read_csv(z_path, index_col=0).values
-            n += 1
+    for sub in list_subjects(outpath):
+        Z += read_subject_matrix(outpath, sub, 'Z', tp='z')
+        n += 1
     if n > 1:
         Z /= (n - 1)
     dif_ind_mean = Z
@@ -474,26 +644,12 @@ def getConnection(input_dir, fdr=False):
     inputdir = input_dir
     if input_dir[-1] in ['/', '\\']:
         inputdir = input_dir[:-1]
-    dirlist = os.listdir(inputdir)
-    assert 'regions.txt' in dirlist, 'regions.txt not found.'
-    f_re = open(inputdir + '/regions.txt', 'r')
-    regions = [line.strip() for line in f_re.readlines()]
-    pati = []
-    for f in dirlist:
-        if os.path.isdir(inputdir + '/' + f):
-            pati.append(f)
-    significant = None
-    for p in pati:
-        Z = read_matrix(inputdir + '/' + p + '/' + p + '_Z.csv', tp='z')
-        if significant is None:
-            significant = np.zeros(Z.shape)
-        _P, correct_P = P(Z)
-        signi_conn_index = np.argwhere(_P < 0.05)
-        if fdr:
-            signi_conn_index = np.argwhere(correct_P < 0.05)
-        if signi_conn_index.shape[0] > 0:
-            rows, cols = zip(*signi_conn_index)
-            significant[rows, cols] = significant[rows, cols] + 1
+    assert os.path.isfile(os.path.join(inputdir, 'regions.txt')), 'regions.txt not found.'
+    with open(os.path.join(inputdir, 'regions.txt'), 'r') as f_re:
+        regions = [line.strip() for line in f_re.readlines()]
+    pati = list_subjects(inputdir)
+    Zs = np.stack([read_subject_matrix(inputdir, p, 'Z', tp='z') for p in pati])
+    significant = count_significant(Zs, fdr=fdr)
     sorted_edges = draw_signifcant(inputdir + '/' + inputdir.strip().split('/')[-1] + '.jpg', significant, regions,
                                    False)
     sg_num = []
@@ -506,13 +662,76 @@ def getConnection(input_dir, fdr=False):
     print('Selected {} edges'.format(len(selected_edges)))
 
     row, col = zip(*selected_edges)
-    df = pd.DataFrame(columns=['Subject'] + [regions[con[0]] + '--' + regions[con[1]] for con in selected_edges])
-    for p in pati:
-        df.loc[len(df.index)] = [p] + list(pd.read_csv(inputdir + '/' + p + '/' + p + '_Z.csv', index_col=0).values[
-                                               row, col].flatten())
+    # Z matrices are already loaded in Zs, so the selected edges are gathered without re-reading
+    df = pd.DataFrame(Zs[:, row, col], columns=[regions[con[0]] + '--' + regions[con[1]] for con in selected_edges])
+    df.insert(0, 'Subject', pati)
     df.to_csv(inputdir + '/sig_' + str(len(selected_edges)) + '.csv', index=False)
 
 
+def _perm_stats_loop(D_permuted, D_obs, diff_real, rows, cols):
+    # 每条边只遍历一次置换轴，同时累计均值/方差（Welford）和大于/小于真实差异的次数
+    n_perm = D_permuted.shape[0]
+    m = rows.shape[0]
+    z_ut = np.zeros(m)
+    p_ut = np.zeros(m)
+    for e in prange(m):
+        i = rows[e]
+        j = cols[e]
+        d = diff_real[i, j]
+        mean = 0.0
+        m2 = 0.0
+        gt = 0
+        lt = 0
+        for k in range(n_perm):
+            x = D_permuted[k, i, j]
+            delta = x - mean
+            mean += delta / (k + 1)
+            m2 += delta * (x - mean)
+            if x > d:
+                gt += 1
+            elif x < d:
+                lt += 1
+        z_ut[e] = (D_obs[i, j] - mean) / np.sqrt(m2 / n_perm)
+        if d > 0:
+            p_ut[e] = (gt + 1) / (n_perm + 1)
+        else:
+            p_ut[e] = (lt + 1) / (n_perm + 1)
+    return z_ut, p_ut
+
+
+if njit is not None:
+    _perm_stats_loop = njit(parallel=True, cache=True, error_model='numpy')(_perm_stats_loop)
+
+
+def perm_stats(D_permuted, D_obs, diff_real, rows, cols):
+    """
+    This method will calculate the Z-score and permutation p-value of the given edges in SCN.
+
+    :param D_permuted: numpy.ndarray
+           permuted differences, shape (n_permutations, n, n).
+    :param D_obs: numpy.ndarray
+           observed differences between Fisher-z transformed PCCs.
+    :param diff_real: numpy.ndarray
+           real differences between PCCs.
+    :param rows: numpy.ndarray
+           row indices of the edges, e.g. np.triu_indices(n, 1)[0].
+    :param cols: numpy.ndarray
+           column indices of the edges.
+    :return: (z, p) of the edges
+    """
+    if njit is not None:
+        return _perm_stats_loop(D_permuted, D_obs, diff_real, rows, cols)
+    n_perm = D_permuted.shape[0]
+    # 把置换轴压成 (n_perm, m) 后一次性计算
+    D_ut = D_permuted[:, rows, cols]
+    d_ut = diff_real[rows, cols]
+    z_ut = (D_obs[rows, cols] - D_ut.mean(axis=0)) / D_ut.std(axis=0)
+    gt = (D_ut > d_ut).sum(axis=0)
+    lt = (D_ut < d_ut).sum(axis=0)
+    p_ut = (np.where(d_ut > 0, gt, lt) + 1) / (n_perm + 1)
+    return z_ut, p_ut
+
+
 def SCN(inpath, outpath, cova=None, region=None, n_permutations=1000):
     outPath = outpath
     if outpath[-1] in ['/', '\\']:
@@ -526,11 +745,14 @@ def SCN(inpath, outpath, cova=None, region=None, n_permutations=1000):
     ctrl = read_dataset(filepath=ctrl_path, tp='ctrl', cova=cova, region=region)
     pati = read_dataset(filepath=pati_path, tp='pati', cova=cova, region=region)
 
-    df = pd.DataFrame(columns=ctrl[1], index=ctrl[1])
     print('calculating real difference ...')
 
-    PCCn = PCC(covas=ctrl[0], regions=ctrl[1], group=ctrl[2])
-    PCCn_p = PCC(covas=pati[1], regions=pati[2], group=pati[3])
+    # 两组数据只转换一次为 numpy 数组，后续的真实差异和置换都直接在数组上计算
+    n_cova = len(ctrl[0])
+    ctrl_arr = ctrl[2][ctrl[0] + ctrl[1]].values.astype(np.float64)
+    pati_arr = pati[3][ctrl[0] + ctrl[1]].values.astype(np.float64)
+    PCCn = _pcc_from_arrays(ctrl_arr[:, :n_cova], ctrl_arr[:, n_cova:])
+    PCCn_p = _pcc_from_arrays(pati_arr[:, :n_cova], pati_arr[:, n_cova:])
 
     # 设置seaborn样式
     sns.set(style='white')
@@ -566,48 +788,51 @@ def SCN(inpath, outpath, cova=None, region=None, n_permutations=1000):
     print('real_diff done.')
     n = diff_real.shape[0]
 
-    g1g2 = pd.concat([ctrl[2], pati[3]])
-
-    # 计算随机差异值
+    g1g2_np = np.vstack([ctrl_arr, pati_arr])
+    # 协变量标准化、脑区以全体均值中心化，残差不变，但正规方程的条件数更好
+    C_all = g1g2_np[:, :n_cova]
+    C_std = C_all.std(axis=0)
+    C_std[C_std == 0] = 1.0
+    X_all = np.column_stack([np.ones(g1g2_np.shape[0]), (C_all - C_all.mean(axis=0)) / C_std])
+    Y_all = g1g2_np[:, n_cova:] - g1g2_np[:, n_cova:].mean(axis=0)
+    n_ctrl = ctrl_arr.shape[0]
+    n_pati = pati_arr.shape[0]
+
+    # 计算随机差异值，每批 batch 次置换一起计算
+    # 两组的叉积由全体叉积相减得到，每次置换只需计算人数较少的一组
     print('calculating permutate difference ...')
+    batch = 100
     D_permuted = np.zeros((n_permutations, n, n))
-    for i in trange(n_permutations, ncols=100):
-        randlabel = list(np.random.permutation(g1g2.shape[0]))
-        g1_per = g1g2.iloc[randlabel[:ctrl[2].shape[0]], :]
-        g2_per = g1g2.iloc[randlabel[ctrl[2].shape[0]:], :]
-        PCCn_per = PCC(covas=ctrl[0], regions=ctrl[1], group=g1_per)
-        PCCn_p_per = PCC(covas=ctrl[0], regions=ctrl[1], group=g2_per)
-        D_permuted[i] = PCCn_p_per - PCCn_per
+    pbar = tqdm(total=n_permutations, ncols=100)
+    for i in range(0, n_permutations, batch):
+        m = min(batch, n_permutations - i)
+        randlabel = np.array([np.random.permutation(g1g2_np.shape[0]) for _ in range(m)])
+        if n_ctrl <= n_pati:
+            PCCn_per, PCCn_p_per = PCC_split_batch(X_all, Y_all, randlabel[:, :n_ctrl])
+        else:
+            PCCn_p_per, PCCn_per = PCC_split_batch(X_all, Y_all, randlabel[:, n_ctrl:])
+        D_permuted[i:i + m] = PCCn_p_per - PCCn_per
+        pbar.update(m)
+    pbar.close()
     print('perm_diff done.')
     # 计算两组之间的边差异
     D_obs = np.abs(np.arctanh(PCCn) - np.arctanh(PCCn_p))
 
-    # 计算 z 值矩阵
+    # 上三角的边索引只计算一次，z、p、fdr_p 都按 (i, j)/(j, i) 对称填充
+    rows, cols = np.triu_indices(n, 1)
+
+    # 计算 z 值和置换检验 p 值
+    z_ut, p_ut = perm_stats(D_permuted, D_obs, diff_real, rows, cols)
     z_matrix = np.zeros((n, n))
-    for i in range(n):
-        for j in range(i + 1, n):
-            z = (D_obs[i, j] - np.mean(D_permuted[:, i, j])) / np.std(D_permuted[:, i, j])
-            z_matrix[i, j] = z
-            z_matrix[j, i] = z
+    z_matrix[rows, cols] = z_ut
+    z_matrix[cols, rows] = z_ut
 
     # 计算 FDR 校正的 p 值矩阵
-    p_matrix = np.zeros((n, n))
-    for i in range(n):
-        for j in range(i + 1, n):
-            if diff_real[i, j] > 0:
-                p = ((D_permuted[:, i, j].flatten() > diff_real[i, j]).astype(np.int_).sum() + 1) / (n_permutations + 1)
-            else:
-                p = ((D_permuted[:, i, j].flatten() < diff_real[i, j]).astype(np.int_).sum() + 1) / (n_permutations + 1)
-            p_matrix[i, j] = p
-            p_matrix[j, i] = p
-    fdr_p_matrix = smsm.multipletests(p_matrix[np.triu_indices(n, 1)], method='fdr_bh')[1]
-    fdr_p = np.zeros((n, n))
-    fdr_p[np.triu_indices(n, 1)] = fdr_p_matrix
-    fdr_p[np.tril_indices(n, -1)] = fdr_p.T[np.tril_indices(n, -1)]
-    fdr_p[np.diag_indices(n)] = 1.0
-
-    df.iloc[:, :] = z_matrix.T
-    df.to_csv(outPath + '/SCN_Z.csv')
-    df.iloc[:, :] = fdr_p.T
-    df.to_csv(outPath + '/SCN_P_FDR.csv')
+    fdr_p_ut = smsm.multipletests(p_ut, method='fdr_bh')[1]
+    fdr_p = np.ones((n, n))
+    fdr_p[rows, cols] = fdr_p_ut
+    fdr_p[cols, rows] = fdr_p_ut
+
+    save_matrix_csv(outPath + '/SCN_Z.csv', z_matrix, ctrl[1])
+    save_matrix_csv(outPath + '/SCN_P_FDR.csv', fdr_p, ctrl[1])
     print('SCN done.')
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'idscn'))
+import main as idscn  # noqa: E402
+
+
+def _cohort(n, const_cova=False, seed=0):
+    rng = np.random.default_rng(seed)
+    C = np.column_stack([rng.integers(20, 60, n), rng.integers(1, 3, n), rng.normal(1.5e6, 1e5, n)]).astype(np.float64)
+    if const_cova:
+        C[:, 1] = 1.0
+    Y = rng.normal(5000, 500, (n, 6)) + C[:, 2:3] * 1e-3
+    return C, Y
+
+
+def _scn_design(C, Y):
+    # same standardization as SCN
+    C_std = C.std(axis=0)
+    C_std[C_std == 0] = 1.0
+    X = np.column_stack([np.ones(C.shape[0]), (C - C.mean(axis=0)) / C_std])
+    return X, Y - Y.mean(axis=0)
+
+
+def _check_split(C, Y, idx):
+    X, Yc = _scn_design(C, Y)
+    P1, P2 = idscn.PCC_split_batch(X, Yc, idx)
+    for k in range(idx.shape[0]):
+        rest = np.setdiff1d(np.arange(C.shape[0]), idx[k])
+        assert np.allclose(P1[k], idscn._pcc_from_arrays(C[idx[k]], Y[idx[k]]), atol=1e-10)
+        assert np.allclose(P2[k], idscn._pcc_from_arrays(C[rest], Y[rest]), atol=1e-10)
+
+
+def test_split_batch_matches_lstsq():
+    C, Y = _cohort(60)
+    rng = np.random.default_rng(1)
+    _check_split(C, Y, np.array([rng.permutation(60)[:25] for _ in range(4)]))
+
+
+def test_split_batch_constant_covariate():
+    C, Y = _cohort(60, const_cova=True)
+    rng = np.random.default_rng(1)
+    _check_split(C, Y, np.array([rng.permutation(60)[:25] for _ in range(4)]))
+
+
+def test_split_batch_covariate_constant_within_split():
+    C, Y = _cohort(60)
+    C[:20, 1] = 1.0
+    C[20:, 1] = 2.0
+    _check_split(C, Y, np.arange(20)[None, :])
+
+
+def _check_add_subject(A, n_cova):
+    basis = idscn.ctrl_basis(A[:-1], n_cova)
+    pcc = idscn.PCC_add_subject(basis, A[-1, :n_cova], A[-1, n_cova:])
+    assert np.allclose(pcc, idscn._pcc_from_arrays(A[:, :n_cova], A[:, n_cova:]), atol=1e-10)
+
+
+def test_add_subject_matches_lstsq():
+    C, Y = _cohort(40)
+    _check_add_subject(np.column_stack([C, Y]), C.shape[1])
+
+
+def test_add_subject_constant_covariate():
+    C, Y = _cohort(40, const_cova=True)
+    _check_add_subject(np.column_stack([C, Y]), C.shape[1])